@@ -10,28 +10,50 @@ Ce que fait l'app
 - Anonymisation aussi dans les commentaires (-- ... , /* ... */).
 - Les chaînes de caractères ne sont pas modifiées.
 - La commande USE est supportée, même sans point-virgule juste avant un SELECT.
+- Les scripts à plusieurs instructions sont analysés en un seul appel au parseur.
 - Les crochets [ ... ] sont préservés (si présents dans le texte d’origine).
 
 Prérequis
 ---------
 pip install streamlit sqlglot
+pip install "sqlglot[rs]" # optionnel : tokenizer Rust, analyse SQL plus rapide
+pip install orjson        # optionnel : sérialisation JSON du mapping plus rapide
 streamlit run app.py
 """
 
 import json
 import re
+import string
+import sys
 import uuid
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 import html as _html
 import streamlit.components.v1 as components
 
 import streamlit as st
-from sqlglot import parse_one, exp
+from sqlglot import Dialect, parse, exp
+
+try:
+    import orjson
+except ImportError:  # dépendance optionnelle
+    orjson = None
+
+if orjson is not None:
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+    _json_loads = json.loads
 
 # -------------------------------
 # Utilities: stable name mapping
 # -------------------------------
 
+# Types d'identifiants, dans l'ordre d'application des remplacements.
+KINDS = ("database", "schema", "table", "column")
+
 DEFAULT_PREFIXES = {
     "database": "DB_",
     "schema": "SC_",
@@ -39,305 +61,556 @@ DEFAULT_PREFIXES = {
     "column": "C_",
 }
 
+# Début d'instruction SQL, à appliquer avec match() sur la ligne sans indentation
+# (mots-clés les plus fréquents en tête)
 SQL_START_RE = re.compile(
-    r"^\s*(SELECT|WITH|UPDATE|INSERT|DELETE|MERGE|CREATE|ALTER|DROP|TRUNCATE|EXEC|DECLARE|BEGIN|USE)\b",
+    r"(SELECT|WITH|INSERT|UPDATE|DELETE|USE|EXEC|DECLARE|CREATE|ALTER|DROP|TRUNCATE|MERGE|BEGIN)\b",
     re.IGNORECASE
 )
 
-def _first_non_comment_code_line(text: str) -> Tuple[int, str]:
+def _classify_input(text: str) -> Tuple[int, int, str]:
     """
-    Retourne (index, contenu) de la première ligne non vide qui n'est pas un commentaire SQL.
-    Si rien trouvé, retourne (-1, "").
+    Analyse le texte collé en un seul passage sur ses lignes.
+    Retourne (position dans le texte de la première ligne non vide qui n'est pas
+    un commentaire SQL, position de la première ligne qui ressemble à un début
+    d'instruction SQL, contenu de la première de ces lignes). -1 / "" si rien trouvé.
+    Les positions permettent de couper le texte par simple tranche (text[pos:]).
     """
-    lines = text.splitlines()
-    for i, line in enumerate(lines):
-        s = line.strip()
-        if not s:
-            continue
-        if s.startswith("--") or s.startswith("/*"):
-            # ligne de commentaire SQL -> on ignore
-            continue
-        return i, line
-    return -1, ""
-
-def _find_first_sql_statement_start(text: str) -> int:
-    """
-    Renvoie l'index de ligne de la première ligne qui ressemble à un début d'instruction SQL.
-    Sinon -1.
-    """
-    lines = text.splitlines()
-    for i, line in enumerate(lines):
-        if SQL_START_RE.search(line):
-            return i
-    return -1
+    first_nb, first_line = -1, ""
+    pos = 0
+    for line in text.splitlines(keepends=True):
+        start, pos = pos, pos + len(line)
+        if first_nb == -1:
+            s = line.strip()
+            if not s or s.startswith("--") or s.startswith("/*"):
+                # ligne vide ou commentaire SQL -> on ignore
+                continue
+            first_nb, first_line = start, line.rstrip("\r\n")
+        if SQL_START_RE.match(line.lstrip()):
+            return first_nb, start, first_line
+    return first_nb, -1, first_line
+
+# Nombre de noms anonymes générés d'avance à chaque extension d'un pool.
+_POOL_CHUNK = 512
 
 def _new_session_id() -> str:
     return str(uuid.uuid4())
 
 class NameMapper:
     """Keeps forward and reverse mappings per identifier type."""
+    __slots__ = (
+        "prefixes", "mapping", "counters", "_inverse", "_pools", "_version",
+        "_forward_cache", "_reverse_cache", "_anonymize_cache", "_deanonymize_cache",
+        "_json_cache", "_json_prefixes", "_json_version",
+    )
+
     def __init__(self, mapping: Dict = None, prefixes: Dict[str, str] = None):
         self.prefixes = prefixes or DEFAULT_PREFIXES.copy()
-        self.mapping = mapping or {
-            "database": {},
-            "schema": {},
-            "table": {},
-            "column": {},
-        }
-        # build reverse
-        self.inverse = {k: {v: k_ for k_, v in d.items()} for k, d in self.mapping.items()}
+        self.mapping = mapping or {k: {} for k in KINDS}
+        # reverse construit à la demande (cf. inverse), inutile si on ne fait qu'anonymiser
+        self._inverse = None
         # counters for new names
         self.counters = {k: (len(d) + 1) for k, d in self.mapping.items()}
+        # noms anonymes pré-générés par type : kind -> (préfixe, [prefix1, prefix2, ...])
+        self._pools = {}
+        # incrémenté à chaque nouvel alias : invalide les caches ci-dessous
+        self._version = 0
+        # réécritures compilées (version, fonction), cf. _build_replacements_*
+        self._forward_cache = None
+        self._reverse_cache = None
+        # derniers résultats d'anonymize_sql / deanonymize_sql (version, sql, résultat)
+        self._anonymize_cache = None
+        self._deanonymize_cache = None
+        # export JSON mis en cache, invalidé quand le mapping ou les préfixes changent
+        self._json_cache = None
+        self._json_prefixes = None
+        self._json_version = -1
+
+    # Réécritures compilées : fermetures locales, non picklables. Exclues de
+    # l'état sérialisé (runner.enforceSerializableSessionState) et simplement
+    # reconstruites au prochain appel.
+    _TRANSIENT = ("_forward_cache", "_reverse_cache")
+
+    def __getstate__(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__ if name not in self._TRANSIENT}
+
+    def __setstate__(self, state: Dict) -> None:
+        for name in self._TRANSIENT:
+            setattr(self, name, None)
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def _gen(self, kind: str) -> str:
-        name = f"{self.prefixes[kind]}{self.counters[kind]}"
+        i = self.counters[kind]
+        prefix = self.prefixes[kind]
+        pool = self._pools.get(kind)
+        if pool is None or pool[0] != prefix:
+            # premier usage, ou préfixe modifié depuis l'UI : nouveau pool
+            pool = self._pools[kind] = (prefix, [])
+        names = pool[1]
+        if i > len(names):
+            names.extend(f"{prefix}{j}" for j in range(len(names) + 1, i + _POOL_CHUNK))
         self.counters[kind] += 1
-        return name
+        return names[i - 1]
 
     def map(self, kind: str, original: str) -> str:
         if not original:
             return original
         d = self.mapping[kind]
-        if original in d:
-            return d[original]
+        alias = d.get(original)
+        if alias is not None:
+            return alias
         alias = self._gen(kind)
+        # noms internés : clés partagées entre mapping et inverse, comparaison
+        # par identité lors des recherches répétées
+        original = sys.intern(original)
         d[original] = alias
-        self.inverse[kind][alias] = original
+        if self._inverse is not None:
+            self._inverse[kind][alias] = original
+        self._version += 1
         return alias
 
+    def _rebuild_inverse(self) -> None:
+        """Construit l'index alias -> original en un seul passage sur le mapping."""
+        inverse = {}
+        for kind, d in self.mapping.items():
+            inv = inverse[kind] = {}
+            for original, alias in d.items():
+                inv[alias] = original
+        self._inverse = inverse
+
+    @property
+    def inverse(self) -> Dict[str, Dict[str, str]]:
+        """
+        Mapping alias -> original par type, construit au premier accès puis
+        seulement complété par map() (index en ajout seul).
+        """
+        if self._inverse is None:
+            self._rebuild_inverse()
+        return self._inverse
+
     def unmap(self, kind: str, alias: str) -> str:
         return self.inverse.get(kind, {}).get(alias, alias)
 
     def to_json(self) -> str:
-        return json.dumps({
+        # Les préfixes sont modifiés directement par l'UI : on compare un instantané.
+        if self._json_version == self._version and self._json_prefixes == self.prefixes:
+            return self._json_cache
+        payload = {
             "prefixes": self.prefixes,
             "mapping": self.mapping,
-        }, ensure_ascii=False, indent=2)
+        }
+        self._json_cache = _json_dumps(payload)
+        self._json_prefixes = dict(self.prefixes)
+        self._json_version = self._version
+        return self._json_cache
 
     @staticmethod
     def from_json(s: str) -> "NameMapper":
-        obj = json.loads(s)
-        return NameMapper(mapping=obj.get("mapping"), prefixes=obj.get("prefixes"))
+        obj = _json_loads(s)
+        # Types internés comme les littéraux de KINDS : les recherches par type
+        # se résolvent par identité plutôt que par comparaison de chaînes.
+        mapping = obj.get("mapping")
+        if mapping:
+            mapping = {
+                sys.intern(kind): {sys.intern(o): sys.intern(a) for o, a in d.items()}
+                for kind, d in mapping.items()
+            }
+        prefixes = obj.get("prefixes")
+        if prefixes:
+            prefixes = {sys.intern(kind): p for kind, p in prefixes.items()}
+        return NameMapper(mapping=mapping, prefixes=prefixes)
 
 # ----------------------------------
 # Mapping extraction using sqlglot
 # ----------------------------------
 
-DIALECT = "tsql"
+# Instance de dialecte résolue une fois pour toutes : évite la recherche dans
+# le registre des dialectes (et l'instanciation) à chaque appel au parseur.
+DIALECT = Dialect.get_or_raise("tsql")
 
-# --- NEW: détection USE (hors chaînes/commentaires) ---
-SEGMENT_RE = re.compile(
-    r"(--[^\n]*\n?|/\*.*?\*/|'(?:''|[^'])*'|\"(?:\"\"|[^\"])*\")",
-    flags=re.DOTALL | re.MULTILINE,
-)
+# --- Découpage code / commentaires / chaînes ---
+# Début possible d'un segment protégé : --, /*, ' ou "
+_SEGMENT_START_RE = re.compile(r"--|/\*|['\"]")
 
+def _quoted_end(sql: str, start: int, quote: str) -> int:
+    """
+    Fin (exclue) de la chaîne ouverte par `quote` en `start`, les guillemets
+    doublés ('' ou "") étant échappés. -1 si la chaîne n'est pas fermée.
+    """
+    j = start + 1
+    last_pair = -1
+    while True:
+        k = sql.find(quote, j)
+        if k == -1:
+            # Non fermée : comme l'ancienne regex (retour arrière), la chaîne
+            # s'arrête au dernier guillemet doublé rencontré, s'il y en a un.
+            return last_pair + 1 if last_pair != -1 else -1
+        if sql.startswith(quote, k + 1):
+            last_pair = k
+            j = k + 2
+            continue
+        return k + 1
+
+def _iter_segments(sql: str):
+    """
+    Découpe le SQL en segments (kind, start, end), kind parmi "code", "comment"
+    et "string" : -- ...\\n, /* ... */, '...' et "...". Une seule passe linéaire,
+    str.find sautant directement au délimiteur fermant (pas de retour arrière,
+    donc pas d'explosion sur un /* ou un guillemet non fermé, qui restent du code).
+    """
+    n = len(sql)
+    code_start = 0
+    i = 0
+    unclosed_block = False  # plus aucun */ après un /* non fermé
+    while True:
+        m = _SEGMENT_START_RE.search(sql, i)
+        if m is None:
+            break
+        i = m.start()
+        c = sql[i]
+        if c == "-":
+            j = sql.find("\n", i + 2)
+            kind, end = "comment", (n if j == -1 else j + 1)
+        elif c == "/":
+            j = -1 if unclosed_block else sql.find("*/", i + 2)
+            unclosed_block = j == -1
+            kind, end = "comment", (-1 if j == -1 else j + 2)
+        else:
+            kind, end = "string", _quoted_end(sql, i, c)
+        if end == -1:
+            # délimiteur non fermé : simple caractère de code
+            i += 1
+            continue
+        if code_start < i:
+            yield "code", code_start, i
+        yield kind, i, end
+        code_start = i = end
+    if code_start < n:
+        yield "code", code_start, n
+
+# USE db | USE [db] : entre crochets, le nom (sans ']', ';' ni saut de ligne
+# interne) peut être entouré d'espaces. Écrit sans quantificateurs qui se
+# chevauchent (pas de \s* suivi d'une classe contenant l'espace) : sur un
+# crochet non fermé suivi de nombreux espaces, la recherche reste linéaire.
+# 'bracket' inclut les espaces d'encadrement, retirés par l'appelant (strip).
 USE_DB_RE = re.compile(
-    r"(?i)\bUSE\s+(?:\[\s*(?P<bracket>[^\]\r\n;]+)\s*\]|(?P<plain>[A-Za-z0-9_.$]+))"
+    r"(?i)\bUSE\s+(?:\[(?P<bracket>\s*[^\]\s;][^\]\r\n;]*(?:[\r\n]\s*)?|[\r\n]*[^\S\r\n]\s*)\]"
+    r"|(?P<plain>[A-Za-z0-9_.$]+))"
 )
 
-def _is_comment(segment: str) -> bool:
-    return segment.startswith("--") or segment.startswith("/*")
-
-def _is_string(segment: str) -> bool:
-    return (segment.startswith("'") and segment.endswith("'")) or (segment.startswith('"') and segment.endswith('"'))
-
-def _scan_code_segments(sql: str):
-    """Itère sur les segments de code (hors chaînes/commentaires)."""
-    last_idx = 0
-    for m in SEGMENT_RE.finditer(sql):
-        # code avant le segment protégé
-        yield sql[last_idx:m.start()]
-        # sauter le segment protégé
-        last_idx = m.end()
-    # suffixe
-    yield sql[last_idx:]
-
-def _map_use_databases(sql: str, nm: NameMapper) -> None:
+def _collect_and_strip_use(sql: str, found: List[Tuple[str, str]]) -> str:
     """
-    Repère les instructions USE ... dans les segments de code et mappe le nom de base.
+    Repère les instructions USE ... dans les segments de code, relève le nom de base
+    et les supprime du texte, afin de permettre à sqlglot de parser correctement
+    les SELECT qui suivent (même sans point-virgule). Un seul parcours des segments.
     Gère : USE db | USE [db] | USE db; | USE [db] ; | USE db SELECT ...
     """
-    for code in _scan_code_segments(sql):
-        for m in USE_DB_RE.finditer(code):
-            name = (m.group("bracket") or m.group("plain") or "").strip()
-            if name:
-                nm.map("database", name)
+    def _take(m):
+        name = (m.group("bracket") or m.group("plain") or "").strip()
+        if name:
+            found.append(("database", name))
+        return ""
+
+    if _SEGMENT_START_RE.search(sql) is None:
+        # ni commentaire ni chaîne : tout le texte est du code
+        return USE_DB_RE.sub(_take, sql)
 
-def _strip_use_for_parse(sql: str) -> str:
-    """
-    Supprime les USE ... uniquement dans les segments de code, afin de permettre à sqlglot
-    de parser correctement les SELECT qui suivent (même sans point-virgule).
-    """
     out = []
-    last_idx = 0
-    for m in SEGMENT_RE.finditer(sql):
-        code = sql[last_idx:m.start()]
-        # supprimer USE ... (ne pas toucher aux chaînes/commentaires)
-        code = USE_DB_RE.sub("", code)
-        out.append(code)
-        # conserver tel quel le segment protégé
-        out.append(m.group(0))
-        last_idx = m.end()
-    tail = sql[last_idx:]
-    tail = USE_DB_RE.sub("", tail)
-    out.append(tail)
+    for kind, start, end in _iter_segments(sql):
+        if kind == "code":
+            # supprimer USE ... (ne pas toucher aux chaînes/commentaires)
+            out.append(USE_DB_RE.sub(_take, sql[start:end]))
+        else:
+            # conserver tel quel le segment protégé
+            out.append(sql[start:end])
     return "".join(out)
 
-def _extract_mapping(sql: str, nm: NameMapper) -> None:
+def _collect_table(node: exp.Table, found: List[Tuple[str, str]]) -> None:
+    """Tables : database.schema.table"""
+    if node.catalog:  # database
+        found.append(("database", str(node.catalog)))
+    if node.db:       # schema
+        found.append(("schema", str(node.db)))
+    if node.this:     # table
+        found.append(("table", node.name))
+
+def _collect_column(node: exp.Column, found: List[Tuple[str, str]]) -> None:
+    """Colonnes potentiellement qualifiées"""
+    if node.this:
+        found.append(("column", node.name))
+
+# Dispatch sur le type exact du nœud : une seule recherche dans un dict
+# par nœud au lieu de plusieurs isinstance().
+_COLLECT_HANDLERS = {
+    exp.Table: _collect_table,
+    exp.Column: _collect_column,
+}
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _collect_identifiers(sql: str) -> List[Tuple[str, str]]:
     """
-    Analyse l'AST pour recenser les identifiants et remplir le mapping,
-    sans produire de SQL réécrit (on réécrit ensuite par remplacement textuel).
+    Recense les identifiants (kind, nom) du script, dans l'ordre de découverte
+    et sans doublons. Fonction pure, mise en cache par texte SQL : un même
+    texte (re-clic, rerun Streamlit) n'est analysé qu'une fois, et le cache ne
+    contient que des listes simples (pas d'AST).
 
-    NEW: on mappe aussi les bases des instructions USE, et on retire
-    ces USE du texte envoyé au parseur pour éviter un échec d'analyse.
+    Les bases des instructions USE sont relevées, puis ces USE sont retirés
+    du texte envoyé au parseur pour éviter un échec d'analyse.
     """
-    # 1) Mapper les bases rencontrées dans USE ...
-    _map_use_databases(sql, nm)
+    found = []
 
-    # 2) Retirer USE du texte à parser pour ne garder que les SELECT/UPDATE/...
-    sql_for_parse = _strip_use_for_parse(sql)
+    # Bases rencontrées dans USE ..., retirées du texte à parser pour ne garder
+    # que les SELECT/UPDATE/...
+    sql_for_parse = _collect_and_strip_use(sql, found)
 
     try:
-        tree = parse_one(sql_for_parse, read=DIALECT)
+        trees = parse(sql_for_parse, read=DIALECT)
     except Exception:
         # Si l’analyse échoue, on ignore : l’anonymisation par remplacement
         # s’appliquera quand même aux parties détectables (USE inclus).
-        return
+        return list(dict.fromkeys(found))
 
-    def _visit(node):
-        # Tables: database.schema.table
-        if isinstance(node, exp.Table):
-            if node.catalog:  # database
-                nm.map("database", str(node.catalog))
-            if node.db:       # schema
-                nm.map("schema", str(node.db))
-            if node.this:     # table
-                nm.map("table", node.name)
-
-        # Colonnes potentiellement qualifiées
-        if isinstance(node, exp.Column):
-            if node.this:
-                nm.map("column", node.name)
-        for child in node.args.values():
-            if isinstance(child, list):
-                for c in child:
-                    if isinstance(c, exp.Expression):
-                        _visit(c)
-            elif isinstance(child, exp.Expression):
-                _visit(child)
-
-    _visit(tree)
+    # Parcours itératif en profondeur (pré-ordre) : l'ordre de découverte fixe
+    # la numérotation des alias. Les instructions vides (';' isolés) sont ignorées.
+    handlers = _COLLECT_HANDLERS
+    for node in (n for tree in trees if tree is not None for n in tree.walk(bfs=False)):
+        handler = handlers.get(node.__class__)
+        if handler is not None:
+            handler(node, found)
+    return list(dict.fromkeys(found))
+
+def _extract_mapping(sql: str, nm: NameMapper) -> None:
+    """
+    Recense les identifiants du SQL et remplit le mapping, sans produire de SQL
+    réécrit (on réécrit ensuite par remplacement textuel).
+    """
+    for kind, name in _collect_identifiers(sql):
+        nm.map(kind, name)
 
 # ----------------------------------
 # Text rewriting helpers
 # ----------------------------------
 
+# Fragments communs des motifs d'identifiants : [ nom ] ou nom en limites de
+# mot (identifiants T-SQL: lettres, chiffres, _, $).
+_BRK_L = r"\[\s*"
+_BRK_R = r"\s*\]"
+_WORD_LB = r"(?<![\w$])"
+_WORD_RB = r"(?![\w$])"
+
+def _identifier_regex(alternation: str) -> str:
+    """Motif [nom] (groupe 'bracketed') ou nom nu (groupe 'bare') pour une alternance de noms."""
+    return (
+        _BRK_L + "(?P<bracketed>" + alternation + ")" + _BRK_R
+        + "|" + _WORD_LB + "(?P<bare>" + alternation + ")" + _WORD_RB
+    )
+
+def _splice_matches(sql: str, scan: str, pattern: re.Pattern, resolve, spans) -> str:
+    """
+    Remplace, dans les plages (start, end) de `spans`, chaque correspondance de
+    `pattern` cherchée dans `scan` (même longueur que `sql`) par resolve(m).
+    Le reste de `sql` est recopié tel quel ; le résultat est assemblé en un seul
+    "".join, sans chaîne intermédiaire par plage ni par motif.
+    `spans` n'est parcouru que si `pattern` trouve au moins une correspondance
+    dans tout `scan` : sinon, aucune plage ne peut en contenir.
+    """
+    if pattern.search(scan) is None:
+        return sql
+    out = []
+    cursor = 0
+    for start, end in spans:
+        for m in pattern.finditer(scan, start, end):
+            out.append(sql[cursor:m.start()])
+            out.append(resolve(m))
+            cursor = m.end()
+    if not out:
+        return sql
+    out.append(sql[cursor:])
+    return "".join(out)
+
 def _build_replacements_forward(nm: NameMapper):
     """
-    Crée les paires (pattern -> repl) pour anonymiser.
-    On remplace formes bracketées puis non bracketées, pour DB/SC/T/C.
+    Crée la réécriture pour anonymiser : un seul motif compilé, alternance de
+    tous les noms d'origine (DB/SC/T/C), en crochets ou non, résolu via un dict.
+    Une seule passe sur le texte au lieu d'une passe par identifiant.
+    Renvoie une fonction (sql, plages) -> sql, ou None si le mapping est vide ;
+    mise en cache sur le mapper tant qu'aucun alias n'est ajouté.
     """
-    repls = []
-
-    def add_kind(kind: str):
-        for original, alias in nm.mapping[kind].items():
-            # [original] -> [alias] (IGNORECASE)
-            repls.append((
-                re.compile(rf"\[\s*{re.escape(original)}\s*\]", flags=re.IGNORECASE),
-                f"[{alias}]"
-            ))
-            # non-bracketed en limites de mot (identifiants T-SQL: lettres, chiffres, _, $)
-            repls.append((
-                re.compile(rf"(?<![\w$]){re.escape(original)}(?![\w$])", flags=re.IGNORECASE),
-                alias
-            ))
-
-    for k in ("database", "schema", "table", "column"):
-        add_kind(k)
-
-    return repls
+    cached = nm._forward_cache
+    if cached is not None and cached[0] == nm._version:
+        return cached[1]
+
+    # clé en minuscules (comparaison insensible à la casse) ; à nom égal, le
+    # premier type/la première découverte l'emporte, comme avec l'ancien
+    # remplacement séquentiel
+    lookup = {}
+    originals = {}
+    for k in KINDS:
+        for original, alias in nm.mapping[k].items():
+            key = original.lower()
+            if key not in lookup:
+                lookup[key] = alias
+                originals[key] = original
+    if not lookup:
+        nm._forward_cache = (nm._version, None)
+        return None
+
+    def _body(names) -> str:
+        # les plus longs d'abord : "Order Details" avant "Order"
+        return _identifier_regex("|".join(re.escape(name) for name in sorted(names, key=len, reverse=True)))
+
+    # Motif sans IGNORECASE, appliqué au texte mis en minuscules : évite le
+    # repli de casse caractère par caractère dans le moteur de regex.
+    pattern = re.compile(_body(lookup))
+    fallback = []  # motif IGNORECASE sur les noms d'origine, compilé au premier besoin
+
+    def _alias(name: str):
+        alias = lookup.get(name.lower())
+        if alias is None:
+            # casse Unicode où lower() et IGNORECASE divergent (ex. 'İ') : la
+            # correspondance vient du motif de repli, construit sur les noms
+            # d'origine, c'est donc contre eux qu'on la résout
+            alias = next(
+                (lookup[key] for key, original in originals.items()
+                 if re.fullmatch(re.escape(original), name, re.IGNORECASE)),
+                None,
+            )
+        return alias
+
+    def _resolve(m: re.Match) -> str:
+        name = m.group("bracketed")
+        if name is not None:
+            # [original] -> [alias]
+            alias = _alias(name)
+            return m.group(0) if alias is None else f"[{alias}]"
+        # non-bracketed en limites de mot (identifiants T-SQL: lettres, chiffres, _, $)
+        alias = _alias(m.group("bare"))
+        return m.group(0) if alias is None else alias
+
+    def rewrite(sql: str, spans) -> str:
+        lowered = sql.lower()
+        if len(lowered) == len(sql):
+            # correspondances cherchées dans `lowered`, texte recopié depuis `sql`
+            # (casse d'origine conservée hors identifiants)
+            return _splice_matches(sql, lowered, pattern, _resolve, spans)
+        # minuscules de longueur différente (ex. 'İ') : positions non
+        # transposables, on repasse par IGNORECASE sur le texte d'origine
+        if not fallback:
+            fallback.append(re.compile(_body(originals.values()), flags=re.IGNORECASE))
+        return _splice_matches(sql, sql, fallback[0], _resolve, spans)
+
+    nm._forward_cache = (nm._version, rewrite)
+    return rewrite
 
 def _build_replacements_reverse(nm: NameMapper):
     """
-    Crée les paires (pattern -> repl) pour dé-anonymiser.
-    Ici pas d'IGNORECASE, on connaît précisément les alias (DB_1, SC_1, ...).
+    Crée la réécriture pour dé-anonymiser : un seul motif compilé qui reconnaît
+    tout alias (préfixe + numéro : DB_1, SC_1, T_12, ...), en crochets ou non,
+    et le résout via un dict. Une seule passe sur le texte, quel que soit le
+    nombre d'alias. Ici pas d'IGNORECASE, on connaît précisément les alias.
+    Renvoie une fonction (sql, plages) -> sql, ou None si le mapping est vide ;
+    mise en cache sur le mapper tant qu'aucun alias n'est ajouté.
     """
-    repls = []
+    cached = nm._reverse_cache
+    if cached is not None and cached[0] == nm._version:
+        return cached[1]
+
+    lookup = {}
+    for k in KINDS:
+        for alias, original in nm.inverse.get(k, {}).items():
+            # alias identique dans deux types (mêmes préfixes) : le premier type l'emporte
+            lookup.setdefault(alias, original)
+    if not lookup:
+        nm._reverse_cache = (nm._version, None)
+        return None
+
+    # Préfixes tirés des alias eux-mêmes (et non de nm.prefixes) : couvre les
+    # alias générés avant un changement de préfixe ou importés tels quels.
+    stems = set()
+    literals = []
+    for alias in lookup:
+        stem = alias.rstrip("0123456789")
+        if stem != alias:
+            stems.add(stem)
+        else:
+            literals.append(alias)
+    alias_re = "|".join(
+        [re.escape(stem) + r"\d+" for stem in sorted(stems, key=len, reverse=True)]
+        + [re.escape(alias) for alias in sorted(literals, key=len, reverse=True)]
+    )
+    pattern = re.compile(_identifier_regex(alias_re))
 
-    def add_kind(kind: str):
-        for alias, original in nm.inverse.get(kind, {}).items():
+    def _resolve(m: re.Match) -> str:
+        alias = m.group("bracketed")
+        if alias is not None:
             # [alias] -> [original]
-            repls.append((
-                re.compile(rf"\[\s*{re.escape(alias)}\s*\]"),
-                f"[{original}]"
-            ))
-            # non-bracketed
-            repls.append((
-                re.compile(rf"(?<![\w$]){re.escape(alias)}(?![\w$])"),
-                original
-            ))
-
-    for k in ("database", "schema", "table", "column"):
-        add_kind(k)
-
-    return repls
-
-def _apply_all(text: str, repls) -> str:
-    for pattern, rep in repls:
-        text = pattern.sub(rep, text)
-    return text
-
-def _apply_replacements_to_code_and_comments(sql: str, repls) -> str:
+            original = lookup.get(alias)
+            return m.group(0) if original is None else f"[{original}]"
+        # non-bracketed
+        return lookup.get(m.group("bare"), m.group(0))
+
+    def rewrite(sql: str, spans) -> str:
+        return _splice_matches(sql, sql, pattern, _resolve, spans)
+
+    nm._reverse_cache = (nm._version, rewrite)
+    return rewrite
+
+def _unquoted_spans(sql: str):
+    """
+    Itère sur les plages (start, end) code + commentaires comprises entre deux
+    chaînes ('...' ou "..."). Une plage commence juste après un guillemet
+    fermant : les limites de mot vues par un motif y sont les mêmes que sur un
+    découpage du texte.
+    Une plage se termine aussi après chaque commentaire -- ... : son saut de
+    ligne final est un espace pour \[\s*nom\s*\], qui pourrait sinon relier un
+    '[' du commentaire au ']' de la ligne suivante et avaler ce saut de ligne
+    (le code suivant se retrouverait en commentaire).
     """
-    Applique les remplacements sur les segments 'code' ET 'commentaires',
+    run_start = 0
+    for kind, start, end in _iter_segments(sql):
+        if kind == "string":
+            yield run_start, start
+            run_start = end
+        elif kind == "comment" and sql.startswith("--", start):
+            yield run_start, end
+            run_start = end
+    yield run_start, len(sql)
+
+def _apply_replacements_to_code_and_comments(sql: str, rewrite) -> str:
+    """
+    Applique la réécriture sur les segments 'code' ET 'commentaires',
     mais JAMAIS à l'intérieur des chaînes ('...' ou "...").
     """
-    out = []
-    last_idx = 0
-    for m in SEGMENT_RE.finditer(sql):
-        # segment avant (code)
-        code = sql[last_idx:m.start()]
-        out.append(_apply_all(code, repls))  # remplacements dans code
-
-        seg = m.group(0)
-        if _is_string(seg):
-            # ne pas toucher
-            out.append(seg)
-        else:
-            # commentaire -> on anonymise aussi
-            out.append(_apply_all(seg, repls))
-        last_idx = m.end()
-
-    # suffixe (code)
-    tail = sql[last_idx:]
-    out.append(_apply_all(tail, repls))
-    return "".join(out)
-
-def copy_to_clipboard_button(text: str, key: str, label: str = "📋 Copier"):
-    """Affiche un bouton qui copie 'text' dans le presse-papiers (côté navigateur)."""
-    if not text:
-        return
-    # On échappe pour éviter de casser le HTML quand le SQL contient des caractères spéciaux
-    escaped = _html.escape(text, quote=True)
-    components.html(f"""
+    if rewrite is None:
+        return sql
+    if "'" not in sql and '"' not in sql and "--" not in sql:
+        # ni chaîne ni commentaire de ligne : une seule plage, sans découpage
+        return rewrite(sql, ((0, len(sql)),))
+    # Plages produites à la demande : si aucun identifiant n'apparaît dans le
+    # texte, la réécriture rend `sql` sans découper les segments.
+    return rewrite(sql, _unquoted_spans(sql))
+
+# Gabarit HTML/JS du bouton de copie, construit une fois au chargement du module
+_CLIP_TPL = string.Template("""
         <div>
-          <textarea id="{key}_ta" style="position:absolute; left:-10000px; top:-10000px;">{escaped}</textarea>
-          <button id="{key}_btn" style="margin-top:8px; padding:6px 10px; border-radius:8px; cursor:pointer;">
-            {label}
+          <textarea id="${key}_ta" style="position:absolute; left:-10000px; top:-10000px;">${escaped}</textarea>
+          <button id="${key}_btn" style="margin-top:8px; padding:6px 10px; border-radius:8px; cursor:pointer;">
+            ${label}
           </button>
-          <span id="{key}_msg" style="margin-left:8px; color:gray; font-size:0.9em;"></span>
+          <span id="${key}_msg" style="margin-left:8px; color:gray; font-size:0.9em;"></span>
         </div>
         <script>
-          const btn = document.getElementById("{key}_btn");
-          const ta  = document.getElementById("{key}_ta");
-          const msg = document.getElementById("{key}_msg");
-          if (btn && ta) {{
-            btn.onclick = async () => {{
-              try {{
+          const btn = document.getElementById("${key}_btn");
+          const ta  = document.getElementById("${key}_ta");
+          const msg = document.getElementById("${key}_msg");
+          if (btn && ta) {
+            btn.onclick = async () => {
+              try {
                 await navigator.clipboard.writeText(ta.value);
                 msg.textContent = "Copié !";
                 setTimeout(() => (msg.textContent = ""), 1500);
-              }} catch(e) {{
+              } catch(e) {
                 // Fallback: sélection + execCommand pour navigateurs anciens
                 ta.style.display = "block";
                 ta.select();
@@ -345,11 +618,19 @@ def copy_to_clipboard_button(text: str, key: str, label: str = "📋 Copier"):
                 ta.style.display = "none";
                 msg.textContent = "Copié !";
                 setTimeout(() => (msg.textContent = ""), 1500);
-              }}
-            }};
-          }}
+              }
+            };
+          }
         </script>
-    """, height=60)
+""")
+
+def copy_to_clipboard_button(text: str, key: str, label: str = "📋 Copier"):
+    """Affiche un bouton qui copie 'text' dans le presse-papiers (côté navigateur)."""
+    if not text:
+        return
+    # On échappe pour éviter de casser le HTML quand le SQL contient des caractères spéciaux
+    escaped = _html.escape(text, quote=True)
+    components.html(_CLIP_TPL.substitute(key=key, label=label, escaped=escaped), height=60)
 
 def anonymize_sql(sql: str, nm: NameMapper):
     """
@@ -358,13 +639,30 @@ def anonymize_sql(sql: str, nm: NameMapper):
     -> Gère USE et crochets naturellement.
     """
     _extract_mapping(sql, nm)
+    if not any(nm.mapping.values()):
+        # Aucune table/colonne/base connue (SELECT 1, EXEC sp_who, texte non
+        # analysable...) : rien à réécrire, on évite la construction des motifs
+        # et le parcours des segments.
+        return sql, nm
+    # Re-clic / rerun sur le même texte sans nouvel identifiant : même résultat
+    cached = nm._anonymize_cache
+    if cached is not None and cached[0] == nm._version and cached[1] == sql:
+        return cached[2], nm
     forward = _build_replacements_forward(nm)
     new_sql = _apply_replacements_to_code_and_comments(sql, forward)
+    nm._anonymize_cache = (nm._version, sql, new_sql)
     return new_sql, nm
 
 def deanonymize_sql(sql: str, nm: NameMapper) -> str:
+    if not any(nm.mapping.values()):
+        # mapping vide (session neuve) : aucun alias à rétablir
+        return sql
+    cached = nm._deanonymize_cache
+    if cached is not None and cached[0] == nm._version and cached[1] == sql:
+        return cached[2]
     reverse = _build_replacements_reverse(nm)
     new_sql = _apply_replacements_to_code_and_comments(sql, reverse)
+    nm._deanonymize_cache = (nm._version, sql, new_sql)
     return new_sql
 
 # --------------
@@ -381,10 +679,14 @@ if "name_mapper" not in st.session_state:
 st.title("🔐 Anonymiseur de requêtes SQL Server (réversible)")
 
 with st.expander("⚙️ Options"):
-    cols = st.columns(4)
-    for i, kind in enumerate(["database", "schema", "table", "column"]):
-        new_prefix = cols[i].text_input(f"Préfixe {kind}", value=st.session_state.name_mapper.prefixes[kind])
-        st.session_state.name_mapper.prefixes[kind] = new_prefix
+    # Formulaire : une seule soumission (un seul rerun) pour les quatre préfixes
+    with st.form("prefix_form"):
+        cols = st.columns(4)
+        new_prefixes = {}
+        for i, kind in enumerate(KINDS):
+            new_prefixes[kind] = cols[i].text_input(f"Préfixe {kind}", value=st.session_state.name_mapper.prefixes[kind])
+        if st.form_submit_button("Appliquer"):
+            st.session_state.name_mapper.prefixes.update(new_prefixes)
     st.caption("Les préfixes servent à générer les noms anonymes : DB_1, SC_1, T_1, C_1, etc.")
 
     st.markdown("**📥 Importer un mapping** (JSON)")
@@ -398,12 +700,13 @@ with st.expander("⚙️ Options"):
             st.error(f"Impossible d'importer le mapping: {e}")
 
     st.markdown("**📤 Exporter le mapping courant**")
-    mapping_json = st.session_state.name_mapper.to_json()
+    # data callable : le JSON n'est produit qu'au clic (hors thread du script,
+    # d'où la liaison directe au mapper plutôt qu'à st.session_state).
     st.download_button(
         label="Télécharger le mapping JSON",
         file_name="mapping_sql_anonymizer.json",
         mime="application/json",
-        data=mapping_json,
+        data=st.session_state.name_mapper.to_json,
     )
     auto_clean = st.checkbox("Nettoyer automatiquement le texte non-SQL avant la première instruction", value=True, help="Si coché, les lignes situées avant la première instruction SQL (SELECT/INSERT/...) seront ignorées.")
 
@@ -424,13 +727,12 @@ with left:
             st.warning("Veuillez coller une requête SQL.")
         else:
             # --- Contrôle d’entrée ---
-            idx_first, first_line = _first_non_comment_code_line(src_sql)
-            if idx_first != -1 and not SQL_START_RE.search(first_line):
+            pos_first, pos_stmt, first_line = _classify_input(src_sql)
+            if pos_first != -1 and pos_stmt != pos_first:
                 # L’utilisateur a du texte non SQL avant la requête
-                start_stmt = _find_first_sql_statement_start(src_sql)
-                if auto_clean and start_stmt != -1:
+                if auto_clean and pos_stmt != -1:
                     # Nettoyage automatique : on coupe tout avant la première ligne SQL
-                    src_sql = "\n".join(src_sql.splitlines()[start_stmt:])
+                    src_sql = src_sql[pos_stmt:]
                     st.info("Du texte non SQL a été détecté avant la requête et a été ignoré automatiquement.")
                 else:
                     st.error(
@@ -467,11 +769,10 @@ with right:
             st.warning("Veuillez coller une requête SQL.")
         else:
             # --- Contrôle d’entrée ---
-            idx_first, first_line = _first_non_comment_code_line(mod_sql)
-            if idx_first != -1 and not SQL_START_RE.search(first_line):
-                start_stmt = _find_first_sql_statement_start(mod_sql)
-                if auto_clean and start_stmt != -1:
-                    mod_sql = "\n".join(mod_sql.splitlines()[start_stmt:])
+            pos_first, pos_stmt, first_line = _classify_input(mod_sql)
+            if pos_first != -1 and pos_stmt != pos_first:
+                if auto_clean and pos_stmt != -1:
+                    mod_sql = mod_sql[pos_stmt:]
                     st.info("Du texte non SQL a été détecté avant la requête et a été ignoré automatiquement.")
                 else:
                     st.error(
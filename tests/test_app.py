@@ -0,0 +1,51 @@
+"""
+Tests de non-régression d'app.py (anonymisation / dé-anonymisation).
+
+Lancement : python -m unittest discover -s tests
+"""
+
+import logging
+import os
+import sys
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py construit l'UI Streamlit à l'import : hors `streamlit run`, Streamlit
+# ne fait qu'émettre des avertissements, qu'on rend muets.
+logging.disable(logging.CRITICAL)
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    import app
+logging.disable(logging.NOTSET)
+
+from app import NameMapper, anonymize_sql, deanonymize_sql
+
+
+class UnicodeCaseFoldingTest(unittest.TestCase):
+    """Noms dont lower() change la longueur (ex. 'İ') : motif IGNORECASE de repli."""
+
+    def test_dotted_capital_i_in_identifiers_and_comments(self):
+        nm = NameMapper()
+        sql = "SELECT İsim FROM Kişi -- isim: müşteri adı"
+        anon, _ = anonymize_sql(sql, nm)
+        self.assertEqual(anon, "SELECT C_1 FROM T_1 -- C_1: müşteri adı")
+        self.assertEqual(deanonymize_sql(anon, nm), "SELECT İsim FROM Kişi -- İsim: müşteri adı")
+
+    def test_dotted_capital_i_bracketed(self):
+        nm = NameMapper()
+        anon, _ = anonymize_sql("SELECT [İsim] FROM [Kişi] WHERE x = 'İsim'", nm)
+        self.assertEqual(anon, "SELECT [C_1] FROM [T_1] WHERE C_2 = 'İsim'")
+
+
+class ImportedMappingTest(unittest.TestCase):
+    """Mapping importé en JSON, pas forcément complet."""
+
+    def test_deanonymize_with_missing_kinds(self):
+        nm = NameMapper.from_json('{"mapping": {"table": {"Users": "T_1"}}}')
+        self.assertEqual(deanonymize_sql("SELECT * FROM [T_1]", nm), "SELECT * FROM [Users]")
+
+
+if __name__ == "__main__":
+    unittest.main()